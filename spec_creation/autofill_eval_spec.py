@@ -2,27 +2,216 @@ import argparse
 import logging
 import json
 import copy
-import arrow
+import functools
+import datetime
+import dateutil.tz
 import requests
 import osmapi
 import re
+import hashlib
+import shelve
 import polyline as pl
 import osrm as osrm
 import shapely.geometry as geo
-
-sensing_configs = json.load(open("sensing_regimes.all.specs.json"))
-
+import numpy as np
+
+# orjson is significantly faster on large, coordinate heavy specs, but it is
+# not part of the standard environment, so fall back to json if it is missing
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def _load_json(file_name):
+    with open(file_name, "rb") as fp:
+        return orjson.loads(fp.read()) if orjson is not None else json.load(fp)
+
+def _dump_json(obj, file_name):
+    if orjson is not None:
+        with open(file_name, "wb") as fp:
+            fp.write(orjson.dumps(obj, option=orjson.OPT_INDENT_2))
+    else:
+        with open(file_name, "w") as fp:
+            json.dump(obj, fp, indent=2)
+
+# Loaded on first use instead of at import time, so that importing this module
+# (e.g. from the ground truth notebooks) does not need to read the regimes file
+@functools.lru_cache(maxsize=1)
+def get_sensing_configs():
+    return _load_json("sensing_regimes.all.specs.json")
+
+# A single client and session for the whole run, so that we reuse the
+# underlying connections instead of opening a new one for every request
+_OSM = osmapi.OsmApi()
+_session = requests.Session()
+
+OVERPASS_URL = "https://overpass-api.de/api/interpreter"
+
+# Routes are deterministic given their inputs, so we persist them across runs.
+# Delete this file to force the routes to be recomputed
+ROUTE_CACHE_FILE = ".route_cache"
+
+def _get_cached(key, fetch_fn):
+    with shelve.open(ROUTE_CACHE_FILE) as cache:
+        if key in cache:
+            logging.debug("Found cached result for %s" % key)
+            return cache[key]
+    result = fetch_fn()
+    with shelve.open(ROUTE_CACHE_FILE) as cache:
+        cache[key] = result
+    return result
+
+# Parse an ISO formatted date into an integer timestamp
+# If timezone is specified, the date is interpreted as a local date in that
+# timezone (overriding any offset in the string), otherwise dates without an
+# offset are treated as UTC. This matches what we used to get from
+# arrow.get(fmt_date).replace(tzinfo=timezone).timestamp and
+# arrow.get(fmt_date).timestamp, without the cost of importing arrow
+def fmt_date_to_ts(fmt_date, timezone=None):
+    dt = datetime.datetime.fromisoformat(fmt_date)
+    if timezone is not None:
+        tz = dateutil.tz.gettz(timezone)
+        assert tz is not None, "Unknown timezone %s" % timezone
+        dt = dt.replace(tzinfo=tz)
+    elif dt.tzinfo is None:
+        dt = dt.replace(tzinfo=datetime.timezone.utc)
+    return int(dt.timestamp())
+
+# The validate_and_fill_* stages modify the spec in place and return it for
+# convenience. The nested entries were always shared with the input, so a
+# shallow copy of the top level did not protect the caller anyway
 def validate_and_fill_datetime(current_spec):
-    ret_spec = copy.copy(current_spec)
     timezone = current_spec["region"]["timezone"]
-    ret_spec["start_ts"] = arrow.get(current_spec["start_fmt_date"]).replace(tzinfo=timezone).timestamp
-    ret_spec["end_ts"] = arrow.get(current_spec["end_fmt_date"]).replace(tzinfo=timezone).timestamp
-    return ret_spec
+    current_spec["start_ts"] = fmt_date_to_ts(current_spec["start_fmt_date"], timezone)
+    current_spec["end_ts"] = fmt_date_to_ts(current_spec["end_fmt_date"], timezone)
+    return current_spec
+
+# OSM elements rarely change between runs, so we also persist the nodes and
+# ways that we download, along with the version returned by the OSM API.
+# Run with --refresh-osm to ignore the stored entries and download them again
+OSM_CACHE_FILE = ".osm_cache"
+REFRESH_OSM_CACHE = False
+
+def _get_osm_cached(element_type, element_ids):
+    if REFRESH_OSM_CACHE or len(element_ids) == 0:
+        return {}
+    ret_map = {}
+    with shelve.open(OSM_CACHE_FILE) as cache:
+        for eid in element_ids:
+            key = "%s/%d" % (element_type, eid)
+            if key in cache:
+                ret_map[eid] = cache[key]
+    logging.debug("Found %d of %d %ss in the OSM cache" %
+        (len(ret_map), len(element_ids), element_type))
+    return ret_map
+
+def _put_osm_cached(element_type, element_map):
+    if len(element_map) == 0:
+        return
+    with shelve.open(OSM_CACHE_FILE) as cache:
+        for eid, e in element_map.items():
+            cache["%s/%d" % (element_type, eid)] = e
+
+# Waypoints and locations are frequently repeated across tests and legs, so
+# we cache the lookups and only go to the network once per node.
+# node id -> (lon, lat)
+_node_lon_lat = {}
+
+def _add_nodes(node_details_map):
+    for nid, nd in node_details_map.items():
+        _node_lon_lat[nid] = (nd["lon"], nd["lat"])
+
+def _store_nodes(node_details_map):
+    _add_nodes(node_details_map)
+    _put_osm_cached("node", {nid: {"version": nd["version"],
+        "lon": nd["lon"], "lat": nd["lat"]} for nid, nd in node_details_map.items()})
+
+# Keep the multi-fetch URLs well below the typical server limits
+NODES_GET_CHUNK_SIZE = 200
+
+# Make sure that all the specified nodes are in the in-memory cache, reading
+# them from the OSM cache if possible and fetching the rest in bulk
+def _fill_node_cache(node_ids):
+    missing_ids = list(dict.fromkeys(nid for nid in node_ids if nid not in _node_lon_lat))
+    _add_nodes(_get_osm_cached("node", missing_ids))
+    missing_ids = [nid for nid in missing_ids if nid not in _node_lon_lat]
+    for i in range(0, len(missing_ids), NODES_GET_CHUNK_SIZE):
+        chunk = missing_ids[i:i+NODES_GET_CHUNK_SIZE]
+        logging.debug("Fetching %d nodes in one call" % len(chunk))
+        if len(chunk) == 1:
+            _store_nodes({chunk[0]: _OSM.NodeGet(chunk[0])})
+        else:
+            _store_nodes(_OSM.NodesGet(chunk))
 
 def node_to_geojson_coords(node_id):
-    osm = osmapi.OsmApi()
-    node_details = osm.NodeGet(node_id)
-    return [node_details["lon"], node_details["lat"]]
+    _fill_node_cache([node_id])
+    # return a fresh list every time since callers embed it into the spec
+    return list(_node_lon_lat[node_id])
+
+# Batched version of node_to_geojson_coords. Uses the OSM multi-fetch endpoint
+# to retrieve all uncached nodes in as few calls as possible.
+# Returns a dict of node_id -> [lon, lat]
+def nodes_to_geojson_coords(node_ids):
+    _fill_node_cache(node_ids)
+    return {nid: list(_node_lon_lat[nid]) for nid in node_ids}
+
+def _get_osm_ids(loc, geometry_type):
+    if loc is None:
+        return []
+    loc_list = loc if isinstance(loc, list) else [loc]
+    return [l["properties"]["osm_id"] for l in loc_list
+        if "osm_id" in l["properties"] and l["geometry"]["type"] == geometry_type]
+
+# Collect every node that the pipeline will resolve and fetch them in bulk, so
+# that the per-location lookups in _fill_coords_from_id are cache hits.
+# Polygon osm_ids are way ids, so they are handled by prefetch_way_coords
+def prefetch_node_coords(curr_spec):
+    node_ids = []
+    for t in curr_spec["calibration_tests"]:
+        node_ids.extend(_get_osm_ids(t["start_loc"], "Point"))
+        node_ids.extend(_get_osm_ids(t["end_loc"], "Point"))
+    print("Prefetching %d nodes referenced in the spec" % len(set(node_ids)))
+    return nodes_to_geojson_coords(node_ids)
+
+# way id -> ordered node ids, as returned by the OSM API
+_way_nodes = {}
+
+def _store_way(wid, way_details):
+    _way_nodes[wid] = way_details["nd"]
+    _put_osm_cached("way", {wid: {"version": way_details["version"],
+        "nd": way_details["nd"]}})
+
+# Same as prefetch_node_coords, but for the Polygon locations. Instead of one
+# WayFull call per polygon, we fetch all the ways in one call and then all
+# their nodes through the (batched) node cache
+def prefetch_way_coords(curr_spec):
+    way_ids = []
+    for t in curr_spec["calibration_tests"]:
+        way_ids.extend(_get_osm_ids(t["start_loc"], "Polygon"))
+        way_ids.extend(_get_osm_ids(t["end_loc"], "Polygon"))
+    way_ids = list(dict.fromkeys(wid for wid in way_ids if wid not in _way_nodes))
+    print("Prefetching %d ways referenced in the spec" % len(way_ids))
+    for wid, way_details in _get_osm_cached("way", way_ids).items():
+        _way_nodes[wid] = way_details["nd"]
+    missing_ids = [wid for wid in way_ids if wid not in _way_nodes]
+    if len(missing_ids) > 0:
+        for wid, way_details in _OSM.WaysGet(missing_ids).items():
+            _store_way(wid, way_details)
+    _fill_node_cache([nid for wid in way_ids for nid in _way_nodes[wid]])
+
+# Several legs (e.g. the same commute under different regimes) can share
+# identical waypoints, so dedup the requests in memory before they even reach
+# the disk cache or the network. The coordinates are passed in as tuples so
+# that they are hashable
+@functools.lru_cache(maxsize=4096)
+def _get_route_cached(mode, waypoint_coords_tuple):
+    waypoint_coords = [list(c) for c in waypoint_coords_tuple]
+    overview_geometry_params = {"overview": "full",
+        "geometries": "polyline", "steps": "false"}
+    cache_key = "osrm/%s" % hashlib.sha1(
+        json.dumps([mode, waypoint_coords]).encode()).hexdigest()
+    return _get_cached(cache_key,
+        lambda: osrm.get_route_points(mode, waypoint_coords, overview_geometry_params))
 
 def get_route_coords(mode, waypoint_coords):
     if mode == "CAR" \
@@ -30,10 +219,11 @@ def get_route_coords(mode, waypoint_coords):
       or mode == "BICYCLING" \
       or mode == "BUS":
         # Use OSRM
-        overview_geometry_params = {"overview": "full",
-            "geometries": "polyline", "steps": "false"}
-        route_coords = osrm.get_route_points(mode, waypoint_coords, overview_geometry_params)
-        return route_coords
+        route_coords = _get_route_cached(mode,
+            tuple(tuple(c) for c in waypoint_coords))
+        logging.debug("OSRM route cache: %s" % (_get_route_cached.cache_info(),))
+        # return a copy since the cached value is shared across calls
+        return list(route_coords)
     else:
         raise NotImplementedError("OSRM does not support train modes at this time")
 
@@ -45,28 +235,35 @@ def _fill_coords_from_id(loc):
             loc["geometry"]["coordinates"] = node_to_geojson_coords(loc["properties"]["osm_id"])
         elif loc["geometry"]["type"] == "Polygon":
             # get coords for way returns a tuple of (nodes, points)
-            loc["geometry"]["coordinates"] = [coords_swap(c) for c in get_coords_for_way(loc["properties"]["osm_id"])[1]]
+            loc["geometry"]["coordinates"] = coords_swap_all(get_coords_for_way(loc["properties"]["osm_id"])[1])
     else:
         assert "coordinates" in loc["geometry"],\
             "Location %s does not have either an osmid or specified set of coordinates"
     return loc
 
 def validate_and_fill_calibration_tests(curr_spec):
-    modified_spec = copy.copy(curr_spec)
-    calibration_tests = modified_spec["calibration_tests"]
+    calibration_tests = curr_spec["calibration_tests"]
     for t in calibration_tests:
         _fill_coords_from_id(t["start_loc"])
         _fill_coords_from_id(t["end_loc"])
-        t["config"] = sensing_configs[t["config"]["id"]]
-    return modified_spec
+        t["config"] = get_sensing_configs()[t["config"]["id"]]
+    return curr_spec
 
 def coords_swap(lon_lat):
     return list(reversed(lon_lat))
 
+# Swap a whole list of coordinates in one vectorized pass, instead of
+# allocating a reversed list for every point
+def coords_swap_all(coords_list):
+    if len(coords_list) == 0:
+        return []
+    return np.asarray(coords_list)[:, ::-1].tolist()
+
 def get_route_from_osrm(t, start_coords, end_coords):
     if "route_waypoints" in t:
         waypoints = t["route_waypoints"]
-        waypoint_coords = [node_to_geojson_coords(node_id) for node_id in waypoints]
+        waypoint_coords_map = nodes_to_geojson_coords(waypoints)
+        waypoint_coords = [waypoint_coords_map[node_id] for node_id in waypoints]
         t["waypoint_coords"] = {
             "type": "Feature",
             "properties": {},
@@ -83,9 +280,9 @@ def get_route_from_osrm(t, start_coords, end_coords):
             for wc in waypoint_coords:
                 waypoint_coords.append({
                     "valid_start_fmt_date": wc["properties"]["valid_start_fmt_date"],
-                    "valid_start_ts": arrow.get(wc["properties"]["valid_start_fmt_date"]).timestamp,
+                    "valid_start_ts": fmt_date_to_ts(wc["properties"]["valid_start_fmt_date"]),
                     "valid_end_fmt_date": wc["properties"]["valid_end_fmt_date"],
-                    "valid_end_ts": arrow.get(wc["properties"]["valid_end_fmt_date"]).timestamp,
+                    "valid_end_ts": fmt_date_to_ts(wc["properties"]["valid_end_fmt_date"]),
                     "coordinates": wc["geometry"]["coordinates"]
                 })
     else:
@@ -96,7 +293,7 @@ def get_route_from_osrm(t, start_coords, end_coords):
     return route_coords
 
 def get_route_from_polyline(t):
-    return pl.PolylineCodec().decode(t if isinstance(t, str) else t["polyline"])
+    return pl.decode(t if isinstance(t, str) else t["polyline"])
 
 # Porting the perl script at
 # https://wiki.openstreetmap.org/wiki/Relations/Relations_to_GPX to python
@@ -110,57 +307,101 @@ def get_way_list(relation_details):
             wl.append(member["ref"])
     return wl
 
+# Note that the way can sometimes have the nodes in the reversed order
+# e.g. way 367132251 in relation 9605483 is reversed compared to ways 
+# 368345083 and 27422567 before it
+# this function automatically detects that and reverses the node array
+def _orient_way_nodes(wid, ordered_node_array, prev_last_node=-1):
+    if prev_last_node != -1 and ordered_node_array[-1] == prev_last_node:
+        logging.debug("LAST entry %d matches prev_last_node %d, REVERSING order for %d",
+              ordered_node_array[-1], prev_last_node, wid)
+        ordered_node_array = list(reversed(ordered_node_array))
+    return ordered_node_array
+
 # way details is an array of n-1 node entries followed by a way entry
 # the way entry has an "nd" field which is an array of node ids in the correct
 # order the n-1 node entries are not necessarily in the correct order but
 # provide the id -> lat,lng mapping
-# Note also that the way can sometimes have the nodes in the reversed order
-# e.g. way 367132251 in relation 9605483 is reversed compared to ways 
-# 368345083 and 27422567 before it
-# this function automatically detects that and reverses the node array
+# Ways and nodes that were already prefetched are read from the caches instead
 def get_coords_for_way(wid, prev_last_node=-1):
-    osm = osmapi.OsmApi()
-    lat = {}
-    lon = {}
-    coords_list = []
-    way_details = osm.WayFull(wid)
-    # print("Processing way %d with %d nodes" % (wid, len(way_details) - 1))
-    for e in way_details:
-        if e["type"] == "node":
-            lat[e["data"]["id"]] = e["data"]["lat"]
-            lon[e["data"]["id"]] = e["data"]["lon"]
-        if e["type"] == "way":
-            assert e["data"]["id"] == wid, "Way id mismatch! %d != %d" % (e["data"]["id"], wl[0])
-            ordered_node_array = e["data"]["nd"]
-            if prev_last_node != -1 and ordered_node_array[-1] == prev_last_node:
-                print("LAST entry %d matches prev_last_node %d, REVERSING order for %d" %
-                      (ordered_node_array[-1], prev_last_node, wid))
-                ordered_node_array = list(reversed(ordered_node_array))
-            for on in ordered_node_array:
-                # Returning lat,lon instead of lon,lat to be consistent with
-                # the returned values from OSRM. Since we manually swap the
-                # values later
-                coords_list.append([lat[on], lon[on]])
-    return ordered_node_array, coords_list
+    if wid not in _way_nodes:
+        for cwid, way_details in _get_osm_cached("way", [wid]).items():
+            _way_nodes[cwid] = way_details["nd"]
+    if wid not in _way_nodes:
+        way_details = _OSM.WayFull(wid)
+        # print("Processing way %d with %d nodes" % (wid, len(way_details) - 1))
+        _store_nodes({e["data"]["id"]: e["data"] for e in way_details if e["type"] == "node"})
+        for e in way_details:
+            if e["type"] == "way":
+                assert e["data"]["id"] == wid, "Way id mismatch! %d != %d" % (e["data"]["id"], wid)
+                _store_way(wid, e["data"])
+    _fill_node_cache(_way_nodes[wid])
+    ordered_node_array = _orient_way_nodes(wid, list(_way_nodes[wid]), prev_last_node)
+    # Returning lat,lon instead of lon,lat to be consistent with
+    # the returned values from OSRM. Since we manually swap the
+    # values later. The coordinates are returned as an (N, 2) array
+    # instead of a list of small per-node lists
+    lon_lat = np.array([_node_lon_lat[on] for on in ordered_node_array],
+        dtype=float).reshape(-1, 2)
+    return ordered_node_array, lon_lat[:, ::-1]
+
+# Retrieves the relation, all its member ways and all their nodes in a single
+# call, instead of one WayFull call per way. Returns a tuple of
+# (relation details in the same format as osm.RelationGet,
+#  way id -> ordered node ids, node id -> (lat, lon))
+def get_relation_from_overpass(rid):
+    query = "[out:json]; (relation(%d); >>;); out;" % rid
+    response = _session.post(OVERPASS_URL, data={"data": query})
+    logging.debug("Call to URL %s returns %s" % (response.url, response))
+    response.raise_for_status()
+    relation_details = None
+    ways = {}
+    nodes = {}
+    for e in response.json()["elements"]:
+        if e["type"] == "relation" and e["id"] == rid:
+            relation_details = {"id": e["id"], "member": e["members"]}
+        elif e["type"] == "way":
+            ways[e["id"]] = e["nodes"]
+        elif e["type"] == "node":
+            nodes[e["id"]] = (e["lat"], e["lon"])
+    assert relation_details is not None, "Relation %d not found in overpass response" % rid
+    return relation_details, ways, nodes
 
 def get_coords_for_relation(rid, start_node, end_node):
-    osm = osmapi.OsmApi()
-    relation_details = osm.RelationGet(rid)
+    cache_key = "relation/%d/%d/%d" % (rid, start_node, end_node)
+    return _get_cached(cache_key,
+        lambda: _fetch_coords_for_relation(rid, start_node, end_node))
+
+def _fetch_coords_for_relation(rid, start_node, end_node):
+    relation_details, ways, nodes = get_relation_from_overpass(rid)
     wl = get_way_list(relation_details)
-    print("Relation %d mapped to %d ways" % (rid, len(wl)))
-    coords_list = []
-    on_list = []
+    logging.debug("Relation %d mapped to %d ways", rid, len(wl))
+    # one (N, 2) array of lat,lon per way, same as get_coords_for_way
+    w_coords_arrays = []
+    coords_count = 0
+    # node id -> index of its first occurrence in the concatenated coords
+    on_pos = {}
     prev_last_node = -1
     for wid in wl:
-        w_on_list, w_coords_list = get_coords_for_way(wid, prev_last_node)
-        on_list.extend(w_on_list)
-        coords_list.extend(w_coords_list)
+        w_on_list = _orient_way_nodes(wid, ways[wid], prev_last_node)
+        w_coords_arrays.append(np.array([nodes[on] for on in w_on_list],
+            dtype=float).reshape(-1, 2))
+        for i, on in enumerate(w_on_list, start=coords_count):
+            on_pos.setdefault(on, i)
+        coords_count += len(w_on_list)
         prev_last_node = w_on_list[-1]
-        print("After adding %d entries from wid %d, curr count = %d" % (len(w_on_list), wid, len(coords_list)))
-    start_index = on_list.index(start_node)
-    end_index = on_list.index(end_node)
+        # lazy formatting, since this runs once per way on long relations
+        logging.debug("After adding %d entries from wid %d, curr count = %d",
+            len(w_on_list), wid, coords_count)
+    assert start_node in on_pos, "Start node %d not found in relation %d" % (start_node, rid)
+    assert end_node in on_pos, "End node %d not found in relation %d" % (end_node, rid)
+    start_index = on_pos[start_node]
+    end_index = on_pos[end_node]
     assert start_index <= end_index, "Start index %d is before end %d" % (start_index, end_index)
-    return coords_list[start_index:end_index+1]
+    coords = np.concatenate(w_coords_arrays)
+    # Only the selected segment is converted back to lists, since callers
+    # (and the route cache) expect plain, JSON serializable coordinates
+    return coords[start_index:end_index+1].tolist()
 
 def get_route_from_relation(r):
     # get_coords_for_relation assumes that start and end are both nodes
@@ -180,15 +421,15 @@ def _add_temporal_ground_truth(orig_loc, default_start_fmt_date, default_end_fmt
     for l in loc:
         if l["properties"].get("valid_start_fmt_date") is None:
             l["properties"]["valid_start_fmt_date"] = default_start_fmt_date
-            l["properties"]["valid_start_ts"] = arrow.get(default_start_fmt_date).timestamp
+            l["properties"]["valid_start_ts"] = fmt_date_to_ts(default_start_fmt_date)
         else:
-            l["properties"]["valid_start_ts"] = arrow.get(l["properties"]["valid_start_fmt_date"]).timestamp
+            l["properties"]["valid_start_ts"] = fmt_date_to_ts(l["properties"]["valid_start_fmt_date"])
 
         if l["properties"].get("valid_end_fmt_date") is None:
             l["properties"]["valid_end_fmt_date"] = default_end_fmt_date
-            l["properties"]["valid_end_ts"] = arrow.get(default_end_fmt_date).timestamp
+            l["properties"]["valid_end_ts"] = fmt_date_to_ts(default_end_fmt_date)
         else:
-            l["properties"]["valid_end_ts"] = arrow.get(l["properties"]["valid_end_fmt_date"]).timestamp
+            l["properties"]["valid_end_ts"] = fmt_date_to_ts(l["properties"]["valid_end_fmt_date"])
 
     return loc
 
@@ -206,13 +447,13 @@ def validate_and_fill_leg(orig_leg, default_start_fmt_date, default_end_fmt_date
                 "type": "Feature",
                 "properties": {
                     "valid_start_fmt_date": p["valid_start_fmt_date"],
-                    "valid_start_ts": arrow.get(p["valid_start_fmt_date"]).timestamp,
+                    "valid_start_ts": fmt_date_to_ts(p["valid_start_fmt_date"]),
                     "valid_end_fmt_date": p["valid_end_fmt_date"],
-                    "valid_end_ts": arrow.get(p["valid_end_fmt_date"]).timestamp
+                    "valid_end_ts": fmt_date_to_ts(p["valid_end_fmt_date"])
                 },
                 "geometry": {
                     "type": "LineString",
-                    "coordinates": [coords_swap(c) for c in get_route_from_polyline(p["polyline"])]
+                    "coordinates": coords_swap_all(get_route_from_polyline(p["polyline"]))
                 }
             })
     elif "polyline" in t:
@@ -220,13 +461,13 @@ def validate_and_fill_leg(orig_leg, default_start_fmt_date, default_end_fmt_date
             "type": "Feature",
             "properties": {
                 "valid_start_fmt_date": default_start_fmt_date,
-                "valid_start_ts": arrow.get(default_start_fmt_date).timestamp,
+                "valid_start_ts": fmt_date_to_ts(default_start_fmt_date),
                 "valid_end_fmt_date": default_end_fmt_date,
-                "valid_end_ts": arrow.get(default_end_fmt_date).timestamp
+                "valid_end_ts": fmt_date_to_ts(default_end_fmt_date)
             },
             "geometry": {
                 "type": "LineString",
-                "coordinates": [coords_swap(c) for c in get_route_from_polyline(t)]
+                "coordinates": coords_swap_all(get_route_from_polyline(t))
             }
         })
     else:
@@ -334,12 +575,10 @@ def has_duplicate_legs(trip):
     return len(unique_leg_id_list) != len(leg_id_list)
 
 def validate_and_fill_eval_trips(curr_spec):
-    modified_spec = copy.copy(curr_spec)
-
     default_start_fmt_date = curr_spec["start_fmt_date"]
     default_end_fmt_date = curr_spec["end_fmt_date"]
 
-    eval_trips = modified_spec["evaluation_trips"]
+    eval_trips = curr_spec["evaluation_trips"]
     for t in eval_trips:
         if "legs" in t:
             print("Filling multi-modal trip %s" % t["id"])
@@ -391,17 +630,67 @@ def validate_and_fill_eval_trips(curr_spec):
             assert not has_duplicate_legs(t), \
                 "Found duplicate leg ids in trip %s" % t["id"]
 
-    return modified_spec
+    return curr_spec
 
 def validate_and_fill_sensing_settings(curr_spec):
-    modified_spec = copy.copy(curr_spec)
-    for ss in modified_spec["sensing_settings"]:
+    sensing_configs = get_sensing_configs()
+    for ss in curr_spec["sensing_settings"]:
         for phoneOS, compare_list in ss.items():
             ss[phoneOS] = {}
             ss[phoneOS]["compare"] = compare_list
             ss[phoneOS]["name"] = " v/s ".join(compare_list)
             ss[phoneOS]["sensing_configs"] = [sensing_configs[cr] for cr in compare_list]
-    return modified_spec
+    return curr_spec
+
+def _validate_loc(loc, path):
+    loc_list = loc if isinstance(loc, list) else [loc]
+    for i, l in enumerate(loc_list):
+        assert "osm_id" in l["properties"] or "coordinates" in l["geometry"],\
+            "Location %s[%d] does not have either an osmid or specified set of coordinates" % (path, i)
+
+# Check the structure of the spec before making any network calls, so that a
+# malformed spec fails immediately with the path to the problem instead of
+# partway through the fill
+def validate_spec(curr_spec):
+    sensing_configs = get_sensing_configs()
+    for i, t in enumerate(curr_spec["calibration_tests"]):
+        path = "calibration_tests[%d]" % i
+        for lk in ["start_loc", "end_loc"]:
+            if t.get(lk) is not None:
+                _validate_loc(t[lk], "%s.%s" % (path, lk))
+        assert t["config"]["id"] in sensing_configs,\
+            "%s: unknown sensing config %s" % (path, t["config"]["id"])
+
+    for i, t in enumerate(curr_spec["evaluation_trips"]):
+        legs = [("evaluation_trips[%d].legs[%d]" % (i, j), l)
+            for j, l in enumerate(t["legs"])] if "legs" in t\
+            else [("evaluation_trips[%d]" % i, t)]
+        for path, l in legs:
+            route_sources = [k for k in ["polyline", "polylines"] if k in l]
+            assert len(route_sources) == 1,\
+                "%s: expected exactly one of 'polyline' or 'polylines', found %s" % (path, route_sources)
+            for lk in ["start_loc", "end_loc"]:
+                assert lk in l, "%s: missing %s" % (path, lk)
+                _validate_loc(l[lk], "%s.%s" % (path, lk))
+
+    for i, ss in enumerate(curr_spec["sensing_settings"]):
+        for phoneOS, compare_list in ss.items():
+            for cr in compare_list:
+                assert cr in sensing_configs,\
+                    "sensing_settings[%d].%s: unknown sensing config %s" % (i, phoneOS, cr)
+
+# Fill the whole spec in a single in-place pass over the loaded dict. Each
+# stage only touches its own section (top level dates, calibration_tests,
+# evaluation_trips, sensing_settings), so every nested object is visited once
+def autofill(curr_spec):
+    validate_spec(curr_spec)
+    prefetch_node_coords(curr_spec)
+    prefetch_way_coords(curr_spec)
+    validate_and_fill_datetime(curr_spec)
+    validate_and_fill_calibration_tests(curr_spec)
+    validate_and_fill_eval_trips(curr_spec)
+    validate_and_fill_sensing_settings(curr_spec)
+    return curr_spec
 
 if __name__ == '__main__':
     logging.basicConfig(level=logging.DEBUG)
@@ -409,16 +698,16 @@ if __name__ == '__main__':
 
     parser.add_argument("in_spec_file", help="file to autofill")
     parser.add_argument("out_spec_file", help="autofilled version of in_spec_file")
+    parser.add_argument("--refresh-osm", action="store_true",
+        help="ignore the cached OSM nodes and ways and download them again")
 
     args = parser.parse_args()
+    REFRESH_OSM_CACHE = args.refresh_osm
 
     print("Reading input from %s" % args.in_spec_file) 
-    current_spec = json.load(open(args.in_spec_file))
+    current_spec = _load_json(args.in_spec_file)
 
-    dt_spec = validate_and_fill_datetime(current_spec)
-    calib_spec = validate_and_fill_calibration_tests(dt_spec)
-    eval_spec = validate_and_fill_eval_trips(calib_spec)
-    settings_spec = validate_and_fill_sensing_settings(eval_spec)
+    settings_spec = autofill(current_spec)
    
     print("Writing output to %s" % args.out_spec_file) 
-    json.dump(settings_spec, open(args.out_spec_file, "w"), indent=2)
+    _dump_json(settings_spec, args.out_spec_file)
@@ -2,7 +2,7 @@ import os
 import logging
 import json
 import requests
-import polyline.codec as pc
+import polyline as pl
 
 try:
     osrm_file_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "osrm.json")
@@ -14,6 +14,9 @@ except Exception as e:
     print("OSRM not configured, routing is not possible")
     logging.exception(e)
 
+# Reuse connections to the routing host across calls
+_session = requests.Session()
+
 ###
 # mode is expected to be a ecwp.PredictedModeTypes mode object
 # waypoints are an array of geojson [lng, lat] coordinates
@@ -32,13 +35,13 @@ def get_route(mode, waypoints, params):
     # but let us support both for now
     mode_name = mode.name if "name" in mode else mode
     url_to_query = OSRM_HOST + "/" + OSRM_ROUTES[mode_name] + "/" + route_coords_string
-    response = requests.get(url_to_query, params=params)
+    response = _session.get(url_to_query, params=params)
     logging.debug("Call to URL %s returns %s" % (response.url, response))
     return response.json()
 
 def get_points_from_route_result(route_response_json):
     string_to_encode = route_response_json["routes"][0]["geometry"]
-    decoded_geometry = pc.PolylineCodec().decode(string_to_encode)
+    decoded_geometry = pl.decode(string_to_encode)
     logging.debug("Decoding %s... -> %s..." % (string_to_encode[0:30],
         decoded_geometry[0:3]))
     return decoded_geometry